@@ -5,10 +5,65 @@ Created on Fri Jul 31 13:38:40 2020
 
 @author: lmorton
 """
-from django.utils.functional import cached_property
-import MDSplus as mds
-import xarray as xr
+from functools import lru_cache
+from collections import OrderedDict
+import importlib
+import threading
+import queue
+import time
 import re
+import os
+
+
+class _LazyModule(object):
+    """
+    Stand-in for a heavy module, which is only imported the first time one of
+    its attributes is used. It then replaces itself with the real module in the
+    globals of MDSmonkey, so there is no overhead after that.
+    """
+    def __init__(self,name,alias):
+        self._name = name
+        self._alias = alias
+        self._module = None
+    def _import(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            globals()[self._alias] = self._module
+        return self._module
+    def __getattr__(self,attr):
+        return getattr(self._import(),attr)
+    def __repr__(self):
+        return "<lazy module '%s'>"%self._name
+
+class cached_property(object):
+    """
+    Turns a method into an attribute that is computed on first access, then
+    stored in the instance __dict__. Unlike functools.cached_property (before
+    Python 3.12) there is no lock shared by all instances, so one Leaf that
+    hangs while fetching its data does not hold up the others.
+    """
+    def __init__(self,func):
+        self.func = func
+        self.__doc__ = func.__doc__
+    def __set_name__(self,owner,name):
+        self.name = name
+    def __get__(self,instance,cls=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+mds = _LazyModule("MDSplus","mds")
+xr = _LazyModule("xarray","xr")
+np = _LazyModule("numpy","np")
+
+def _load(*modules):
+    """
+    Import the given lazy modules now instead of on first use
+    """
+    for module in modules:
+        if isinstance(module,_LazyModule):
+            module._import()
 
 
 #TODO: try to find a way to enable multi-shot analysis w/ single tree object, and 
@@ -19,13 +74,10 @@ import re
 
 #TODO: Consider rebasing on mdsconnector -- it can work in 'local' mode instead of ssh
 
-usage_table = mds.tree._usage_table
-usage_integers = [usage_table[utype] for utype in ['NUMERIC','SIGNAL','AXIS','COMPOUND_DATA']]
 
-#TODO: Combine the data_err arrays and description strings into the xarray object
-# This might be too much customization, though: I am not able to test this against all 
-# variations of MDSplus tree structure out there. Maybe I should just leave it like this
-# for generality -- I think it should work quite well as-is.
+#Leafs that commonly hang from a signal Leaf with its errors & description. See
+# Leaf.with_errors -- the signal is still usable on its own if they are absent.
+error_leaves = ['data_err','data_err_h','data_err_l','description']
 
 
 def _parser(text):
@@ -88,7 +140,37 @@ _TDI_text = """    cached              =Nci._nciProp(Flags.CACHED,"True if data
     time_inserted       =Nci._nciProp(Nci.TIME_INSERTED,"64-bit timestamp when data was stored")
     usage_str           =Nci._nciProp(Nci.USAGE_STR,"formal name of the usage of this node")"""
 
-TDI_text = _parser(_TDI_text)
+@lru_cache(maxsize=None)
+def _TDI_table():
+    return _parser(_TDI_text)
+
+@lru_cache(maxsize=None)
+def _usage_table():
+    return mds.tree._usage_table
+
+@lru_cache(maxsize=None)
+def _usage_integers():
+    return [_usage_table()[utype] for utype in ['NUMERIC','SIGNAL','AXIS','COMPOUND_DATA']]
+
+_lazy_tables = {'TDI_text':_TDI_table,'usage_table':_usage_table,'usage_integers':_usage_integers}
+
+def __getattr__(name):
+    """
+    Build the module-level tables (TDI_text, usage_table, usage_integers) the
+    first time they are asked for, so that importing MDSmonkey neither loads
+    MDSplus nor parses the NCI text.
+    """
+    if name not in _lazy_tables:
+        raise AttributeError("module %r has no attribute %r"%(__name__,name))
+    return _lazy_tables[name]()
+
+#Structure listing of every node in the tree, used by get_tree and export_archive
+_LISTING_TDI = ('serializeout(`(_=TreeFindNodeWild("~~~");List(,' 
+                'GETNCI(_,"LENGTH"),'
+                'GETNCI(_,"FULLPATH"),'
+                'GETNCI(_,"USAGE"),'
+                'GETNCI(_,"PATH")'
+                ');))')
 
 def get_stuff(connection,fullpath,TDI):
     """
@@ -147,107 +229,434 @@ def get_data(shot,path, treename = None ,server = None, conn = None):
     dt = lf.data #Just need to trigger the actual grabbing of the data here
     return dt
 
-def get_many(shots,tags,treename = None ,server = None, conn = None, shot_behavior='concat',tag_behavior="merge"):
-    xrdct = {}
+#Data that arrived after fetch_many gave up on it, keyed by (server,treename,shot,tag),
+# oldest first. The next fetch_many for the same item picks it up instead of asking
+# the server. Only the latest retry_cache_size results younger than retry_cache_age
+# seconds are kept, so results nobody asks for again don't pile up.
+_retried = OrderedDict()
+_retried_lock = threading.Lock()
+retry_cache_size = 100
+retry_cache_age = 600.
 
-    for tag in tags:
-        xrdct[tag.strip("\\")] = get_many_shots(shots,tag,treename=treename,server=server,conn=conn,behavior=shot_behavior)
-    if tag_behavior == 'concat':
-        ndlxr = xr.concat(xrdct.values(),dim='channel')
-        return ndlxr.assign_coords({'channel':np.array(list(xrdct.keys()))})
-    elif tag_behavior == 'merge':
+#Requests that fetch_many gave up on but that are still running, keyed by 
+# (server,treename,shot,tag), with the thread running each one: either a hung 
+# worker or a _retry. An item is not asked for again while its thread is alive,
+# and no more replacements or retries are started once max_background_threads
+# of these threads are left running.
+_background = {}
+max_background_threads = 8
+
+def _spawn(target,*args):
+    """
+    Run target in a daemon thread, so that a hung request can't keep the 
+    interpreter from exiting
+    """
+    thread = threading.Thread(target=target,args=args,daemon=True)
+    thread.start()
+    return thread
+
+def _expire():
+    """
+    Drop the late results that are too old or too many. Call with _retried_lock held.
+    """
+    now = time.monotonic()
+    while _retried and (len(_retried) > retry_cache_size or
+                        now - next(iter(_retried.values()))[0] > retry_cache_age):
+        _retried.popitem(last=False)
+
+def _remember(server,treename,item,data):
+    with _retried_lock:
+        key = (server,treename)+item
+        _retried.pop(key,None) #So that it moves to the end
+        _retried[key] = time.monotonic(),data
+        _expire()
+
+def _recall(server,treename,item):
+    """
+    Take the late result for an item out of the cache, or None if there is none
+    """
+    with _retried_lock:
+        _expire()
+        entry = _retried.pop((server,treename)+item,None)
+    return None if entry is None else entry[1]
+
+def _hold(keys,thread):
+    """
+    Note that thread is still working on these (server,treename,shot,tag)
+    """
+    with _retried_lock:
+        for key in keys:
+            _background[key] = thread
+
+def _busy(key):
+    """
+    Whether a thread left running by an earlier fetch_many is working on key
+    """
+    with _retried_lock:
+        thread = _background.get(key)
+        return thread is not None and thread.is_alive()
+
+def _background_threads():
+    """
+    Number of threads fetch_many left running in the background
+    """
+    with _retried_lock:
+        for key in [key for key,thread in _background.items() if not thread.is_alive()]:
+            del _background[key]
+        return len(set(_background.values()))
+
+def _retry(items,treename,server):
+    """
+    Try once more to get items that failed or were never started, in the 
+    background, and leave the results for the next fetch_many
+    """
+    connection = None
+    for item in items:
+        try:
+            if connection is None:
+                connection = mds.connection.Connection(server)
+            _remember(server,treename,item,get_data(item[0],item[1],treename=treename,conn=connection))
+        except Exception:
+            connection = None #Start over with a fresh connection
+
+def fetch_many(items,treename = None ,server = None, conn = None, timeout=None, deadline=None, workers=4):
+    """
+    Get the data of many (shot,tag) pairs with get_data, giving up on any 
+    single request after 'timeout' seconds and on the whole batch after 
+    'deadline' seconds. Whatever has arrived by then is returned, and the
+    items that are missing are retried in the background: if they arrive,
+    the next call asking for them gets them without going to the server (if
+    it comes within retry_cache_age seconds, see _retried).
+    
+    If a server is given, the requests are spread over several worker threads,
+    each with its own connection, and a worker that hangs is replaced. If only
+    'conn' is given the requests have to share it, so they run one at a time,
+    a hung request ends the batch and nothing is retried in the background.
+    
+    An item that a hung worker or a retry from an earlier call is still busy 
+    with is not asked for again: it is reported as 'timeout' until that 
+    thread is done. Once max_background_threads threads are left running 
+    like this, hung workers are no longer replaced (the batch ends) and 
+    nothing more is retried.
+
+    Parameters
+    ----------
+    items : list of (integer,string) tuples
+        (shot number, path) of each signal
+    treename : string, optional
+        name of the MDSplus tree. The default is None.
+    server : string, optional
+        URL of the server to connect to. The default is None.
+    conn : MDSplus.Connection, optional
+        MDSplus connection object, used if no server is given. The default is None.
+    timeout : float, optional
+        seconds to wait for each request. The default is None (forever).
+    deadline : float, optional
+        seconds to wait for the whole batch. The default is None (forever).
+    workers : integer, optional
+        number of requests to run at once, at least 1. The default is 4.
+
+    Returns
+    -------
+    dict
+        maps (shot,tag) to the DataArray, for the items that arrived in time
+    dict
+        maps (shot,tag) to 'ok', 'error', 'timeout' (given up on while 
+        running, or still busy from an earlier call) or 'pending' (never 
+        started before the deadline)
+    """
+    if workers < 1:
+        raise ValueError("fetch_many needs at least one worker, got workers=%r"%(workers,))
+    items = list(dict.fromkeys(items))
+    _load(mds,xr) #So that the imports don't count against the timeouts
+    end = None if deadline is None else time.monotonic() + deadline
+    results = {}
+    status = {}
+    todo = queue.Queue()
+    for item in items:
+        data = None if server is None else _recall(server,treename,item)
+        if data is not None:
+            results[item] = data
+            status[item] = 'ok'
+        elif _busy((server,treename)+item):
+            status[item] = 'timeout'
+        else:
+            todo.put(item)
+
+    cv = threading.Condition()
+    started = {}
+    threads = {}
+    abandoned = set()
+
+    def work():
+        connection = conn if server is None else None
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            with cv:
+                started[item] = time.monotonic()
+                threads[item] = threading.current_thread()
+                cv.notify() #So that its timeout gets counted
+            try:
+                if connection is None:
+                    connection = mds.connection.Connection(server)
+                outcome = 'ok',get_data(item[0],item[1],treename=treename,conn=connection)
+            except Exception:
+                outcome = 'error',None
+                if server is not None:
+                    connection = None #Start over with a fresh connection
+            with cv:
+                if item in abandoned: #Too late, a replacement worker has taken over
+                    if outcome[0] == 'ok' and server is not None:
+                        _remember(server,treename,item,outcome[1])
+                    return
+                status[item] = outcome[0]
+                if outcome[0] == 'ok':
+                    results[item] = outcome[1]
+                cv.notify()
+
+    nworkers = 1 if server is None else min(workers,todo.qsize())
+    for ii in range(nworkers):
+        _spawn(work)
+    with cv:
+        while len(status) < len(items):
+            now = time.monotonic()
+            if end is not None and now >= end:
+                break
+            running = {item:t0 for item,t0 in started.items() if item not in status}
+            hung = [item for item,t0 in running.items() if timeout is not None and now - t0 >= timeout]
+            for item in hung:
+                abandoned.add(item)
+                status[item] = 'timeout'
+                _hold([(server,treename)+item],threads[item])
+            if hung and server is None:
+                break #Nobody else can use the connection
+            if hung and _background_threads() >= max_background_threads:
+                break #Don't leave any more threads behind
+            if hung:
+                for item in hung:
+                    _spawn(work) #Replace the hung worker
+                continue
+            waits = [] if end is None else [end - now]
+            if timeout is not None:
+                waits += [t0 + timeout - now for t0 in running.values()]
+            cv.wait(min(waits) if waits else None)
+        while not todo.empty(): #Stop the idle workers from picking up more
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+        for item in items:
+            if item not in status:
+                abandoned.add(item)
+                status[item] = 'timeout' if item in started else 'pending'
+                if item in started:
+                    _hold([(server,treename)+item],threads[item])
+    missing = [item for item in items if status[item] in ('error','pending')]
+    if missing and server is not None and _background_threads() < max_background_threads:
+        _hold([(server,treename)+item for item in missing],_spawn(_retry,missing,treename,server))
+    return results,status
+
+def _collect(shots,tags,treename,server,conn,timeout,deadline,workers):
+    """
+    Get the data for every shot & tag, either one at a time or with 
+    fetch_many if there is a time limit. In the latter case, also returns
+    the status of each (shot,tag) as a DataArray, otherwise None.
+    """
+    if timeout is None and deadline is None:
+        return {(shot,tag):get_data(shot,tag,treename=treename,server=server,conn=conn)
+                for tag in tags for shot in shots},None
+    results,status = fetch_many([(shot,tag) for tag in tags for shot in shots],treename=treename,
+                                server=server,conn=conn,timeout=timeout,deadline=deadline,workers=workers)
+    mask = xr.DataArray([[status[(shot,tag)] for tag in tags] for shot in shots],dims=('shot','tag'),
+                        coords={'shot':list(shots),'tag':[tag.strip("\\") for tag in tags]},name='status')
+    return results,mask
+
+def _with_status(result,mask):
+    """
+    Attach the status mask from _collect to a result. A DataArray is turned
+    into a Dataset, and the mask becomes its 'status' variable (padding 
+    missing shots with NaN). A dictionary gets a 'status' entry, and lists
+    are left alone (they hold a None for each missing item, see _combine).
+    """
+    if mask is None:
+        return result
+    if isinstance(result,xr.DataArray):
+        result = result.to_dataset(name=result.name or 'data')
+    if isinstance(result,xr.Dataset):
+        result = result.merge(mask,join='outer') #Keep the shots that have no data at all
+    elif isinstance(result,dict):
+        result['status'] = mask
+    return result
+
+def _combine(xrdct,behavior,dim,argname='behavior',keys=None):
+    """
+    Put the DataArrays together as requested by 'behavior' (see get_many_shots).
+    If keys are given, a list has one entry per key, in that order, with None
+    for the keys that are not in xrdct.
+    """
+    if not xrdct and behavior in ('concat','merge'): #Nothing arrived in time
+        return xr.Dataset()
+    if behavior == 'concat':
+        ndlxr = xr.concat(xrdct.values(),dim=dim)
+        return ndlxr.assign_coords({dim:np.array(list(xrdct.keys()))})
+    elif behavior == 'merge':
         return xr.Dataset(xrdct)
-    elif tag_behavior == 'dump':
+    elif behavior == 'dump':
         return xrdct
-    elif tag_behavior == 'list':
-        return list(xrdct.values())
+    elif behavior == 'list':
+        return list(xrdct.values()) if keys is None else [xrdct.get(key) for key in keys]
     else:
-        print("Invalid selection for 'tag_behavior'.")
-    
-def get_many_shots(shots,tag,treename = None ,server = None, conn = None, behavior='concat'):
+        print("Invalid selection for '%s'."%argname)
+
+def get_many(shots,tags,treename = None ,server = None, conn = None, shot_behavior='concat',tag_behavior="merge",
+             timeout=None, deadline=None, workers=4):
     """
-    Produce an xarray.Dataset from a diagnostic Branch of a tree.
-    This causes the data to be pulled from the server, if it has not already
-    been done, so it may be slow the first time.
+    Get several signals for several shots. The shots of each signal are put
+    together as in get_many_shots, then the signals as in get_many_signals.
 
     Parameters
     ----------
-    branch : Branch
-        must be the parent of at least one Leaf that has data
-    subset : list of strings, optional
-        select which of the Leafs to include in the Dataset. The default is all.
+    shots : list of integers
+        shot numbers
+    tags : list of strings
+        paths into the tree
+    treename : string, optional
+        name of the MDSplus tree. The default is None.
+    server : string, optional
+        URL of the server to connect to. The default is None.
+    conn : MDSplus.Connection, optional
+        MDSplus connection object. The default is None.
+    shot_behavior : string, optional
+        how to combine the shots, see get_many_shots. The default is 'concat'.
+    tag_behavior : string, optional
+        how to combine the signals, see get_many_signals. The default is 'merge'.
+    timeout : float, optional
+        seconds to wait for each signal of each shot. The default is None.
+    deadline : float, optional
+        seconds to wait for all of them. The default is None. If either 
+        timeout or deadline is given, the data is fetched with fetch_many: 
+        whatever is missing is left out and retried in the background, and 
+        the result is a Dataset with a 'status' variable over (shot, tag)
+        ('dump' gets a 'status' entry instead, and 'list' keeps a None in 
+        place of each missing item).
+    workers : integer, optional
+        number of requests to run at once, see fetch_many. The default is 4.
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray or dct
+        the collected data
+    """
+    data,mask = _collect(shots,tags,treename,server,conn,timeout,deadline,workers)
+    xrdct = {}
+
+    for tag in tags:
+        shotdct = {shot:data[(shot,tag)] for shot in shots if (shot,tag) in data}
+        if shotdct:
+            xrdct[tag.strip("\\")] = _shots(shotdct,shot_behavior,keys=None if mask is None else shots)
+    keys = None if mask is None else [tag.strip("\\") for tag in tags]
+    return _with_status(_combine(xrdct,tag_behavior,'channel',argname='tag_behavior',keys=keys),mask)
+
+def _shots(xrdct,behavior,keys=None):
+    if behavior == 'merge':
+        xrdct = {"s%d"%shot:val for shot,val in xrdct.items()} #Must prefix by non-numeral
+    return _combine(xrdct,behavior,'shot',keys=keys)
+
+def get_many_shots(shots,tag,treename = None ,server = None, conn = None, behavior='concat',
+                   timeout=None, deadline=None, workers=4):
+    """
+    Get the same signal for several shots.
+
+    Parameters
+    ----------
+    shots : list of integers
+        shot numbers
+    tag : string
+        path into the tree
+    treename : string, optional
+        name of the MDSplus tree. The default is None.
+    server : string, optional
+        URL of the server to connect to. The default is None.
+    conn : MDSplus.Connection, optional
+        MDSplus connection object. The default is None.
     behavior : string, optional
-        If 'merge,' each Leaf appears as a variable. The default is 'concat'.
-        If 'concat,' each Leaf is considered one index along a new dimension
-            called 'channel'
+        If 'merge,' each shot appears as a variable 's<shot>'.
+        If 'concat,' each shot is considered one index along a new dimension
+            called 'shot'. The default is 'concat'.
         If 'dump,' just return a dictionary of the DataArrays for debugging.
         If 'list', returns a list of the DataArrays.
+    timeout : float, optional
+        seconds to wait for each shot. The default is None.
+    deadline : float, optional
+        seconds to wait for all of them. The default is None. If either 
+        timeout or deadline is given, the data is fetched with fetch_many: 
+        whatever is missing is left out and retried in the background, and 
+        the result is a Dataset with a 'status' variable over (shot, tag)
+        ('dump' gets a 'status' entry instead, and 'list' keeps a None in 
+        place of each missing item).
+    workers : integer, optional
+        number of requests to run at once, see fetch_many. The default is 4.
 
     Returns
     -------
     xarray.Dataset or xarray.DataArray or dct
-        the collected data from this diagnostic
+        the collected data
 
     """
-    xrdct = {}
-    
-    for shot in shots:
-        xrdct[shot] = get_data(shot,tag,treename=treename,server=server,conn=conn)
-    if behavior == 'concat':
-        ndlxr = xr.concat(xrdct.values(),dim='shot')
-        return ndlxr.assign_coords({'shot':np.array(list(xrdct.keys()))})
-    elif behavior == 'merge':
-        newdct = {"s%d"%shot:val for shot,val in xrdct.items()} #Must prefix by non-numeral
-        return xr.Dataset(newdct)
-    elif behavior == 'dump':
-        return xrdct
-    elif behavior == 'list':
-        return list(xrdct.values())
-    else:
-        print("Invalid selection for 'behavior'.")
+    data,mask = _collect(shots,[tag],treename,server,conn,timeout,deadline,workers)
+    xrdct = {shot:data[(shot,tag)] for shot in shots if (shot,tag) in data}
+    return _with_status(_shots(xrdct,behavior,keys=None if mask is None else shots),mask)
 
-def get_many_signals(shot,tags,treename = None ,server = None, conn = None,behavior='merge'):
+def get_many_signals(shot,tags,treename = None ,server = None, conn = None,behavior='merge',
+                     timeout=None, deadline=None, workers=4):
     """
-    Produce an xarray.Dataset from a diagnostic Branch of a tree.
-    This causes the data to be pulled from the server, if it has not already
-    been done, so it may be slow the first time.
+    Get several signals for the same shot.
 
     Parameters
     ----------
-    branch : Branch
-        must be the parent of at least one Leaf that has data
-    subset : list of strings, optional
-        select which of the Leafs to include in the Dataset. The default is all.
+    shot : integer
+        shot number
+    tags : list of strings
+        paths into the tree
+    treename : string, optional
+        name of the MDSplus tree. The default is None.
+    server : string, optional
+        URL of the server to connect to. The default is None.
+    conn : MDSplus.Connection, optional
+        MDSplus connection object. The default is None.
     behavior : string, optional
-        If 'merge,' each Leaf appears as a variable. The default is 'merge'.
-        If 'concat,' each Leaf is considered one index along a new dimension
+        If 'merge,' each signal appears as a variable. The default is 'merge'.
+        If 'concat,' each signal is considered one index along a new dimension
             called 'channel'
         If 'dump,' just return a dictionary of the DataArrays for debugging.
         If 'list', returns a list of the DataArrays.
+    timeout : float, optional
+        seconds to wait for each signal. The default is None.
+    deadline : float, optional
+        seconds to wait for all of them. The default is None. If either 
+        timeout or deadline is given, the data is fetched with fetch_many: 
+        whatever is missing is left out and retried in the background, and 
+        the result is a Dataset with a 'status' variable over (shot, tag)
+        ('dump' gets a 'status' entry instead, and 'list' keeps a None in 
+        place of each missing item).
+    workers : integer, optional
+        number of requests to run at once, see fetch_many. The default is 4.
 
     Returns
     -------
     xarray.Dataset or xarray.DataArray or dct
-        the collected data from this diagnostic
+        the collected data
 
     """
-    xrdct = {}
-    
-    for descendant in tags:
-        xrdct[descendant.strip("\\")] = get_data(shot,descendant,treename=treename,server=server,conn=conn)
-    if behavior == 'concat':
-        ndlxr = xr.concat(xrdct.values(),dim='channel')
-        return ndlxr.assign_coords({'channel':np.array(list(xrdct.keys()))})
-    elif behavior == 'merge':
-        return xr.Dataset(xrdct)
-    elif behavior == 'dump':
-        return xrdct
-    elif behavior == 'list':
-        return list(xrdct.values())
-    else:
-        print("Invalid selection for 'behavior'.")
+    data,mask = _collect([shot],tags,treename,server,conn,timeout,deadline,workers)
+    xrdct = {tag.strip("\\"):data[(shot,tag)] for tag in tags if (shot,tag) in data}
+    keys = None if mask is None else [tag.strip("\\") for tag in tags]
+    return _with_status(_combine(xrdct,behavior,'channel',keys=keys),mask)
  
-def get_tree(shot,tree,server,trim_dead_branches=True):
+def get_tree(shot,tree,server,trim_dead_branches=True,conn=None):
     """
     Connect to a server and construct a Python representation of the MDSplus
     tree for a specific shot. The data is pulled as-needed into 
@@ -271,6 +680,9 @@ def get_tree(shot,tree,server,trim_dead_branches=True):
         the shot. This operation can be slow, because evaluating the 'length'
         of the data (which is how dead branches are detected) is slow. Setting
         trim_dead_branches = False is faster, but the tree may be cluttered.
+    conn : MDSplus.Connection or ArchiveConnection, optional
+        connection object to use instead of connecting to the server. Pass an
+        ArchiveConnection to build the tree from an offline archive.
 
     Returns
     -------
@@ -397,18 +809,15 @@ def get_tree(shot,tree,server,trim_dead_branches=True):
         ne  (radius, time) float32 nan nan nan 4.2912584e+18 ... nan nan
         te  (radius, time) float32 nan nan nan 331.0 317.0 ... nan nan 
     """
-    connection = mds.connection.Connection(server)
+    connection = conn
+    if connection is None:
+        connection = mds.connection.Connection(server)
     connection.openTree(tree,shot)
 
     trunk = Branch(r"\{}".format(tree))
     if  trim_dead_branches:
-        lengths, fullpaths,usages,paths = [a.tolist() for a in connection.get((
-        'serializeout(`(_=TreeFindNodeWild("~~~");List(,' 
-        'GETNCI(_,"LENGTH"),'
-        'GETNCI(_,"FULLPATH"),'
-        'GETNCI(_,"USAGE"),'
-        'GETNCI(_,"PATH")'
-        ');))')).deserialize().data()]
+        lengths, fullpaths,usages,paths = [a.tolist() for a in connection.get(
+            _LISTING_TDI).deserialize().data()]
         #The ~~~ is supposed 
         # to yield breadth-first search, so that I can assume all the branches
         # are encountered before the leaves that hang from them
@@ -605,8 +1014,8 @@ class Leaf(Branch):
         'leaf.data' refers to leaf.__dict__['data'] which is the xarray object.
         """
         if self.__usage__ == -1: #Hasn't been checked b/c we did dead_branches == True
-            self.__usage__ = get_stuff(self.__connection__,self.__fullpath__,"usage")
-        if self.__usage__ in usage_integers:
+            self.__usage__ = int(get_stuff(self.__connection__,self.__fullpath__,"usage"))
+        if self.__usage__ in _usage_integers():
             try:
                 return getXarray(self)
             except mds.mdsExceptions.MDSplusException:
@@ -631,6 +1040,21 @@ class Leaf(Branch):
                 print("Error: could not connect to the server")
                 return "Leaf %s\n"%self.__path__
         return "Leaf %s : length of data: %d bytes\n"%(self.__path__,self.__length__)
+    def with_errors(self):
+        """
+        Combine the data with the errors and description stored in the 
+        'data_err', 'data_err_h', 'data_err_l' and 'description' Leafs below
+        this one, if present. Those are all requested from the server at once.
+
+        Returns
+        -------
+        xarray.Dataset
+            the data, plus '<name>_err', '<name>_err_h' and '<name>_err_l' 
+            variables sharing its coordinates. The description is put into
+            the attributes of the data variable.
+        """
+        name = self.data.name
+        return errorDataset(self,name,fetch_companions([self]))
     
     
 
@@ -679,9 +1103,104 @@ def getXarray(leaf):
         dims.reverse()
         return xr.DataArray(data,dims=dims,coords=dims_dict,attrs={"units":units},
                             name =  chop(leaf.__path__,depth=0)[-1].strip(r"\\"))
-import numpy as np
 
-def diagnosticXarray(branch,subset=None,behavior='merge'):
+def get_batch(connection,expressions):
+    """
+    Evaluate several TDI expressions in a single round trip to the server
+
+    Parameters
+    ----------
+    connection : MDSplus.Connection
+        live connection to the server
+    expressions : list of strings
+        TDI expressions, eg paths into the tree
+
+    Returns
+    -------
+    list
+        the data of each expression, in order
+    """
+    return connection.get('serializeout(`List(,%s))'%",".join(expressions)).deserialize().data()
+
+def fetch_companions(leaves):
+    """
+    Get the data of the error & description Leafs hanging from several Leafs
+    with one request. If the batch fails (eg, one of the nodes is empty) each
+    one is requested separately instead, and the ones that fail are left out.
+
+    Parameters
+    ----------
+    leaves : list of Leaf
+        the Leafs whose companions are wanted. Must share a connection.
+
+    Returns
+    -------
+    dict
+        maps each companion Leaf to its data
+    """
+    values = {}
+    pending = []
+    for leaf in leaves:
+        for name in error_leaves:
+            companion = getattr(leaf,name,None)
+            if type(companion) != Leaf:
+                continue
+            if 'data' in companion.__dict__: #Already cached, no need to ask again
+                values[companion] = companion.data
+            else:
+                pending.append(companion)
+    if pending:
+        conn = pending[0].__connection__
+        try:
+            values.update(zip(pending,get_batch(conn,[c.__path__ for c in pending])))
+        except mds.mdsExceptions.MDSplusException:
+            for companion in pending:
+                try:
+                    values[companion] = conn.get(companion.__path__).data()
+                except mds.mdsExceptions.MDSplusException:
+                    print("Could not get %s, leaving it out."%companion.__path__)
+    return values
+
+def errorDataset(leaf,name,companion_values):
+    """
+    Assemble the data of a Leaf and its errors & description into a Dataset
+
+    Parameters
+    ----------
+    leaf : Leaf
+        the Leaf holding the signal
+    name : string
+        name of the data variable. The errors are named after it, eg 
+        '<name>_err_h'
+    companion_values : dict
+        data of the companion Leafs, as from fetch_companions
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    data = leaf.data
+    ds = xr.Dataset({name:data})
+    for companion_name in error_leaves:
+        companion = getattr(leaf,companion_name,None)
+        if companion not in companion_values:
+            continue
+        value = companion_values[companion]
+        if companion_name == 'description':
+            ds[name].attrs['description'] = str(value)
+            continue
+        value = getattr(value,'values',value) #A cached companion is a DataArray
+        errname = name + companion_name[len('data'):]
+        if np.shape(value) == data.shape:
+            ds[errname] = xr.DataArray(value,dims=data.dims,coords=data.coords,
+                                       attrs={"units":data.attrs.get("units","")})
+        else: #Can't share the coordinates, so give it its own dimensions
+            value = np.asarray(value)
+            ds[errname] = xr.DataArray(value,dims=["%s_dim_%d"%(errname,ii) for ii in range(value.ndim)],
+                                       attrs={"units":data.attrs.get("units","")})
+    return ds
+
+def diagnosticXarray(branch,subset=None,behavior='merge',include_errors=False):
     """
     Produce an xarray.Dataset from a diagnostic Branch of a tree.
     This causes the data to be pulled from the server, if it has not already
@@ -699,6 +1218,13 @@ def diagnosticXarray(branch,subset=None,behavior='merge'):
             called 'channel'
         If 'dump,' just return a dictionary of the DataArrays for debugging.
         If 'list', returns a list of the DataArrays.
+    include_errors : bool, optional
+        If True, each Leaf is combined with its errors & description, as in 
+        Leaf.with_errors, and Datasets take the place of the DataArrays. The
+        errors of all the Leafs are requested from the server at once. With 
+        'merge' the variables are named '<leaf>', '<leaf>_err', etc; with
+        'concat' they are named 'data', 'data_err', etc, and the descriptions 
+        are a 'description' coordinate along 'channel'. The default is False.
 
     Returns
     -------
@@ -712,9 +1238,21 @@ def diagnosticXarray(branch,subset=None,behavior='merge'):
     for descendant in subset:
         descendant = str(descendant)
         obj= getattr(branch,descendant)
-        if (type(obj) == Leaf) and (obj.__usage__ in usage_integers):
+        if (type(obj) == Leaf) and (obj.__usage__ in _usage_integers()):
             data = obj.data
             xrdct[descendant.strip("\\")] = data
+    if include_errors:
+        leaves = {key:getattr(branch,key) for key in xrdct.keys()}
+        companion_values = fetch_companions(list(leaves.values()))
+        xrdct = {key:errorDataset(leaf,'data' if behavior == 'concat' else key,companion_values)
+                 for key,leaf in leaves.items()}
+        if behavior == 'merge':
+            return xr.merge(xrdct.values())
+        if behavior == 'concat': #concat would keep only the first description
+            descriptions = [ds['data'].attrs.pop('description','') for ds in xrdct.values()]
+            ndlxr = xr.concat(xrdct.values(),dim='channel')
+            return ndlxr.assign_coords({'channel':np.array(list(xrdct.keys())),
+                                        'description':('channel',descriptions)})
     if behavior == 'concat':
         ndlxr = xr.concat(xrdct.values(),dim='channel')
         return ndlxr.assign_coords({'channel':np.array(list(xrdct.keys()))})
@@ -726,6 +1264,269 @@ def diagnosticXarray(branch,subset=None,behavior='merge'):
         return list(xrdct.values())
     else:
         print("Invalid selection for 'behavior'.")
- 
 
-       
\ No newline at end of file
+
+def _archive_group(tree,shot):
+    """
+    Name of the archive group that holds one shot of one tree
+    """
+    return "%s/s%d"%(tree.lower(),shot) #Must prefix by non-numeral
+
+def _archive_read(filename,group):
+    """
+    Open one group of an archive. Zarr stores are chunked and read lazily,
+    straight from disk. HDF5 groups are loaded whole and the file is closed
+    again, because netCDF4 does not cope with many handles on one file.
+    """
+    if filename.rstrip("/").endswith(".zarr"):
+        return xr.open_zarr(filename,group=group)
+    return xr.load_dataset(filename,group=group)
+
+def _archive_write(ds,filename,group):
+    """
+    Write one group into an archive, creating the archive if necessary
+    """
+    if filename.rstrip("/").endswith(".zarr"):
+        ds.to_zarr(filename,group=group,mode='w')
+    else:
+        ds.to_netcdf(filename,group=group,mode='a' if os.path.exists(filename) else 'w')
+
+def _archive_has(filename,group):
+    try:
+        if filename.rstrip("/").endswith(".zarr"):
+            xr.open_zarr(filename,group=group).close()
+        else:
+            xr.open_dataset(filename,group=group).close()
+    except (OSError,KeyError,ValueError):
+        return False
+    return True
+
+def _archive_nodes(filename,group):
+    """
+    Numbers of the nodes whose data is in the archive for one shot
+    """
+    if filename.rstrip("/").endswith(".zarr"):
+        import zarr
+        names = zarr.open_group(filename,mode='r')[group].group_keys()
+    else:
+        import netCDF4
+        with netCDF4.Dataset(filename) as root:
+            names = list(root[group].groups)
+    return {int(name[1:]) for name in names if re.match(r"n\d+$",name)}
+
+def _in_subset(fullpath,subset):
+    """
+    True if the node is selected by one of the full paths in subset, either
+    directly or by being a descendant of a selected node
+    """
+    fullpath = fullpath.lstrip("\\")
+    for item in subset:
+        item = item.lower().strip().lstrip("\\")
+        if item == fullpath:
+            return True
+        if fullpath.startswith(item) and fullpath[len(item):len(item)+1] in (".",":"):
+            return True
+    return False
+
+def export_archive(shot,tree,server,filename,subset=None,trim_dead_branches=True,conn=None):
+    """
+    Snapshot a shot into a local archive so that it can be analyzed later
+    without a server, using ArchiveConnection. The structure listing of the
+    whole tree is stored, along with the data of the selected Leafs (as
+    produced by getXarray). Several shots and trees may share one archive.
+    
+    The export is resumable: each Leaf is written as soon as it has been 
+    fetched, and Leafs that are already in the archive are skipped, so an 
+    interrupted export can simply be run again.
+
+    Parameters
+    ----------
+    shot : integer
+        shot number
+    tree : string
+        the MDSplus tree to connect to
+    server : string
+        URL of the server to connect to
+    filename : string
+        path of the archive. Names ending in '.zarr' produce a zarr store, 
+        anything else an HDF5 (netCDF4) file.
+    subset : list of strings, optional
+        paths or tags of the Leafs (or Branches) to archive. The default is all.
+        The nodes below them (eg, errors & description) are archived as well.
+    trim_dead_branches : bool, optional
+        If True, skip nodes with no data for the shot. The default is True.
+    conn : MDSplus.Connection, optional
+        MDSplus connection object. The default is None.
+
+    Returns
+    -------
+    list of strings
+        full paths of the Leafs that could not be archived. Run the export 
+        again to retry them.
+
+    Usage examples:
+    --------------
+    
+    > export_archive(101010,"phys","my.server.com","phys.zarr",subset=["phys::top.physics"])
+    > tree = get_tree(101010,"phys",None,conn=ArchiveConnection("phys.zarr"))
+    """
+    if conn is None:
+        conn = mds.connection.Connection(server)
+    conn.openTree(tree,shot)
+    group = _archive_group(tree,shot)
+    if _archive_has(filename,group+"/structure"):
+        #Reuse the stored listing so that the node numbering stays the same
+        structure = _archive_read(filename,group+"/structure").load()
+    else:
+        lengths,fullpaths,usages,paths = [a.tolist() for a in conn.get(
+            _LISTING_TDI).deserialize().data()]
+        structure = xr.Dataset({"length":("node",np.array(lengths,dtype=np.int64)),
+                                "fullpath":("node",np.array([p.decode("utf-8").strip() for p in fullpaths])),
+                                "usage":("node",np.array(usages,dtype=np.int32)),
+                                "path":("node",np.array([p.decode("utf-8").strip() for p in paths]))},
+                               attrs={"shot":shot,"tree":tree})
+        _archive_write(structure,filename,group+"/structure")
+
+    if subset is not None: #Turn tags into full paths, so they bring their descendants along too
+        tags = {str(path).lower().strip().lstrip("\\"):str(fullpath) for path,fullpath
+                in zip(structure.path.values,structure.fullpath.values)}
+        subset = [tags.get(item.lower().strip().lstrip("\\"),item) for item in subset]
+    archived = _archive_nodes(filename,group)
+    failed = []
+    for ii in range(structure.sizes["node"]):
+        usage = int(structure.usage[ii])
+        length = int(structure.length[ii])
+        fullpath = str(structure.fullpath.values[ii]).lower()
+        path = str(structure.path.values[ii])
+        if usage <= 1 or (trim_dead_branches and length <= 0):
+            continue
+        if subset is not None and not _in_subset(fullpath,subset):
+            continue
+        if ii in archived:
+            continue
+        leaf = Leaf(shot,tree,fullpath,conn,path,usage=usage,length=length)
+        try:
+            data = leaf.data
+        except mds.mdsExceptions.MDSplusException:
+            print("Could not fetch %s, it was not archived."%fullpath)
+            failed.append(fullpath)
+            continue
+        if isinstance(data,xr.DataArray):
+            ds = data.to_dataset(name="value")
+        else:
+            data = np.asarray(data)
+            dims = ["raw_%d"%jj for jj in range(data.ndim)]
+            ds = xr.Dataset({"value":(dims,data)})
+        _archive_write(ds,filename,"%s/n%d"%(group,ii))
+    return failed
+
+def _split_args(text):
+    """
+    Split a TDI argument list at the commas that are not inside parentheses
+    """
+    args = []
+    depth = start = 0
+    for ii,char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            args.append(text[start:ii].strip())
+            start = ii+1
+    args.append(text[start:].strip())
+    return args
+
+class _ArchiveReply(object):
+    """
+    Stand-in for the MDSplus data objects returned by Connection.get
+    """
+    def __init__(self,value):
+        self.value = value
+    def data(self):
+        return self.value
+    def deserialize(self):
+        return self
+    def __int__(self):
+        return int(self.value)
+
+class ArchiveConnection(object):
+    """
+    Replays an archive written by export_archive through the same 'get' and
+    'openTree' methods as MDSplus.Connection, so that get_tree, get_data, 
+    diagnosticXarray, etc. work with no server at all. Only the expressions
+    that MDSmonkey itself sends are understood. Like the server, it raises
+    TreeNNF for unknown nodes and TreeNODATA for data that was not archived.
+    """
+    def __init__(self,filename):
+        self.filename = filename
+        self.group = None
+        self._datasets = {}
+    def openTree(self,tree,shot):
+        group = _archive_group(tree,shot)
+        if group == self.group:
+            return
+        structure = _archive_read(self.filename,group+"/structure").load()
+        #Nodes whose data was not archived look like empty structure nodes, 
+        # so that get_tree leaves them out
+        archived = np.isin(np.arange(structure.sizes["node"]),list(_archive_nodes(self.filename,group)))
+        structure["length"] = structure.length.where(archived,0)
+        structure["usage"] = structure.usage.where(archived,_usage_table()['STRUCTURE'])
+        self.group = group
+        self._datasets = {} #They belong to the shot that was open before
+        self._structure = structure
+        self._index = {}
+        for ii,(fullpath,path) in enumerate(zip(structure.fullpath.values,structure.path.values)):
+            self._index[str(fullpath).lower().strip()] = ii
+            self._index[str(path).lower().strip()] = ii
+    def reconnect(self):
+        self._datasets = {}
+    def _node(self,path):
+        try:
+            return self._index[path.lower().strip()]
+        except KeyError:
+            raise mds.mdsExceptions.TreeNNF() from None
+    def _dataset(self,path):
+        ii = self._node(path)
+        if ii not in self._datasets:
+            try:
+                self._datasets[ii] = _archive_read(self.filename,"%s/n%d"%(self.group,ii))
+            except (OSError,KeyError,ValueError):
+                raise mds.mdsExceptions.TreeNODATA() from None
+        return self._datasets[ii]
+    def get(self,exp,*args):
+        """
+        Evaluate one of the TDI expressions used by MDSmonkey against the archive
+        """
+        if self.group is None:
+            raise ValueError("Call openTree before requesting data")
+        for arg in args:
+            exp = exp.replace("$",str(arg),1)
+        exp = exp.strip()
+        if "TreeFindNodeWild" in exp:
+            fields = re.findall(r'GETNCI\(_,"(\w+)"\)',exp)
+            return _ArchiveReply([self._listing(field) for field in fields])
+        match = re.match(r'serializeout\(`List\(,(.*)\)\)$',exp,re.IGNORECASE)
+        if match:
+            return _ArchiveReply([self.get(item).data() for item in _split_args(match.group(1))])
+        match = re.match(r'UNITS_OF\(DIM_OF\((.+),(\d+)\)\)$',exp,re.IGNORECASE)
+        if match:
+            coord = self._dataset(match.group(1))["dim_%s"%match.group(2)]
+            return _ArchiveReply(np.str_(coord.attrs.get("units","")))
+        match = re.match(r'DIM_OF\((.+),(\d+)\)$',exp,re.IGNORECASE)
+        if match:
+            return _ArchiveReply(self._dataset(match.group(1))["dim_%s"%match.group(2)].values)
+        match = re.match(r'UNITS_OF\((.+)\)$',exp,re.IGNORECASE)
+        if match:
+            value = self._dataset(match.group(1))["value"]
+            return _ArchiveReply(np.str_(value.attrs.get("units","")))
+        match = re.match(r'GETNCI\((.+),"(\w+)"\)$',exp,re.IGNORECASE)
+        if match:
+            ii = self._node(match.group(1))
+            return _ArchiveReply(self._listing(match.group(2))[ii])
+        return _ArchiveReply(self._dataset(exp)["value"].values)
+    def _listing(self,field):
+        values = self._structure[field.lower()].values
+        if field.lower() in ("fullpath","path"):
+            return np.char.encode(values.astype(str),"utf-8") #The server sends bytes
+        return values
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure how long 'import MDSmonkey' takes in a fresh interpreter, and how much
+resident memory the process holds afterwards. Each sample is a new process, so
+the numbers reflect what a short-lived job pays at startup.
+
+Usage:
+    > python benchmarks/import_benchmark.py            #just the import
+    > python benchmarks/import_benchmark.py --loaded   #import & load MDSplus, xarray
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+#Runs in the child process. Prints the import time in seconds and the peak
+# resident memory in kB (ru_maxrss is in bytes on macOS).
+_child = """
+import resource, sys, time
+start = time.perf_counter()
+import MDSmonkey
+{touch}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss //= 1024
+print(elapsed, rss)
+"""
+
+_touch = "MDSmonkey.usage_integers; MDSmonkey.xr.DataArray"
+
+def sample(loaded=False):
+    """
+    Import MDSmonkey in a new interpreter and return (seconds, kB)
+    """
+    code = _child.format(touch=_touch if loaded else "")
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable,"-c",code],cwd=repo,check=True,
+                         capture_output=True,text=True).stdout.split()
+    return float(out[0]),int(out[1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n","--repeat",type=int,default=20,help="number of fresh interpreters")
+    parser.add_argument("--loaded",action="store_true",help="also load the heavy dependencies")
+    args = parser.parse_args()
+
+    samples = [sample(args.loaded) for ii in range(args.repeat)]
+    times = [t*1e3 for t,rss in samples]
+    rss = [rss for t,rss in samples]
+    print("import MDSmonkey%s, %d runs"%(" (loaded)" if args.loaded else "",args.repeat))
+    print("  time : median %.1f ms, min %.1f ms, max %.1f ms"%(statistics.median(times),min(times),max(times)))
+    print("  rss  : median %.1f MB"%(statistics.median(rss)/1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+A fake MDSplus server, so the tests run without a real one. Install it with
+the 'fake_mds' fixture, which swaps it in for MDSmonkey.mds.
+"""
+import re
+import time
+import types
+
+import numpy as np
+import pytest
+
+xr = pytest.importorskip("xarray")
+import MDSmonkey
+
+
+class MDSplusException(Exception):
+    pass
+
+class TreeNODATA(MDSplusException):
+    pass
+
+class TreeNNF(MDSplusException):
+    pass
+
+usage_table = {'STRUCTURE':1,'ACTION':2,'DEVICE':3,'DISPATCH':4,'NUMERIC':5,'SIGNAL':6,
+               'TASK':7,'TEXT':8,'WINDOW':9,'AXIS':10,'SUBTREE':11,'COMPOUND_DATA':12}
+
+#fullpath, usage, length, path
+NODES = [(r"\PHYS::TOP",1,0,r"\PHYS::TOP"),
+         (r"\PHYS::TOP.DIAG",1,0,r"\PHYS::TOP.DIAG"),
+         (r"\PHYS::TOP.DIAG:NE",6,100,r"\NE"),
+         (r"\PHYS::TOP.DIAG:NE:DATA_ERR",6,100,r"\NE:DATA_ERR"),
+         (r"\PHYS::TOP.DIAG:NE:DATA_ERR_H",6,100,r"\NE:DATA_ERR_H"),
+         (r"\PHYS::TOP.DIAG:NE:DATA_ERR_L",6,100,r"\NE:DATA_ERR_L"),
+         (r"\PHYS::TOP.DIAG:NE:DESCRIPTION",8,10,r"\NE:DESCRIPTION"),
+         (r"\PHYS::TOP.DIAG:TE",6,100,r"\TE"),
+         (r"\PHYS::TOP.DIAG:TE:DATA_ERR",6,100,r"\TE:DATA_ERR"),
+         (r"\PHYS::TOP.DIAG:TE:DESCRIPTION",8,10,r"\TE:DESCRIPTION")]
+
+TIME = np.linspace(0,1,5)
+
+def value_of(path,shot=1):
+    path = path.upper()
+    if path.endswith("DESCRIPTION"):
+        return np.str_("electron density" if "NE" in path else "electron temperature")
+    if path.endswith("DATA_ERR_H"):
+        return np.full(5,.2)
+    if path.endswith("DATA_ERR_L"):
+        return np.full(5,.1)
+    if path.endswith("DATA_ERR"):
+        return np.full(5,.15)
+    return np.arange(5.) + (10 if "TE" in path else 0) + 100*(shot-1)
+
+class Reply(object):
+    def __init__(self,value):
+        self.value = value
+    def data(self):
+        return self.value
+    def deserialize(self):
+        return self
+    def __int__(self):
+        return int(self.value)
+
+class Connection(object):
+    """
+    Answers the TDI expressions MDSmonkey sends. Paths in 'hang' sleep for 
+    that many seconds, paths in 'missing' have no data and shots in 'fail' 
+    can't be opened.
+    """
+    hang = {}
+    missing = set()
+    fail = set()
+    def __init__(self,server=None):
+        self.shot = None
+    def openTree(self,tree,shot):
+        if shot in self.fail:
+            raise MDSplusException("no such shot")
+        self.shot = shot
+    def reconnect(self):
+        pass
+    def get(self,exp,*args):
+        for arg in args:
+            exp = exp.replace("$",str(arg),1)
+        for path,seconds in self.hang.items():
+            if path.lower() in exp.lower():
+                time.sleep(seconds)
+        if "TreeFindNodeWild" in exp:
+            columns = {"FULLPATH":np.array([n[0].encode() for n in NODES]),
+                       "USAGE":np.array([n[1] for n in NODES]),
+                       "LENGTH":np.array([n[2] for n in NODES]),
+                       "PATH":np.array([n[3].encode() for n in NODES])}
+            return Reply([columns[field] for field in re.findall(r'GETNCI\(_,"(\w+)"\)',exp)])
+        match = re.match(r'serializeout\(`List\(,(.*)\)\)$',exp)
+        if match:
+            return Reply([value_of(item,self.shot) for item in match.group(1).split(",")])
+        match = re.match(r'UNITS_OF\(DIM_OF\((.+),(\d+)\)\)$',exp)
+        if match:
+            return Reply(np.str_("s"))
+        match = re.match(r'DIM_OF\((.+),(\d+)\)$',exp)
+        if match:
+            return Reply(TIME)
+        match = re.match(r'UNITS_OF\((.+)\)$',exp)
+        if match:
+            return Reply(np.str_("m^-3"))
+        match = re.match(r'GETNCI\((.+),"(\w+)"\)$',exp)
+        if match:
+            for node in NODES:
+                if match.group(1).upper() in (node[0],node[3]):
+                    return Reply({"USAGE":node[1],"LENGTH":node[2]}[match.group(2).upper()])
+            raise TreeNNF()
+        if exp.upper() in self.missing:
+            raise TreeNODATA()
+        return Reply(value_of(exp,self.shot))
+
+@pytest.fixture
+def fake_mds(monkeypatch):
+    mds = types.SimpleNamespace(
+        tree=types.SimpleNamespace(_usage_table=usage_table),
+        mdsExceptions=types.SimpleNamespace(MDSplusException=MDSplusException,
+                                            TreeNODATA=TreeNODATA,TreeNNF=TreeNNF),
+        connection=types.SimpleNamespace(Connection=Connection))
+    monkeypatch.setattr(MDSmonkey,"mds",mds)
+    MDSmonkey._usage_table.cache_clear()
+    MDSmonkey._usage_integers.cache_clear()
+    monkeypatch.setattr(Connection,"hang",{})
+    monkeypatch.setattr(Connection,"missing",set())
+    monkeypatch.setattr(Connection,"fail",set())
+    monkeypatch.setattr(MDSmonkey,"_retried",MDSmonkey.OrderedDict())
+    monkeypatch.setattr(MDSmonkey,"_background",{})
+    yield mds
+    MDSmonkey._usage_table.cache_clear()
+    MDSmonkey._usage_integers.cache_clear()
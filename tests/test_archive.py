@@ -0,0 +1,46 @@
+import pytest
+
+import MDSmonkey
+
+
+@pytest.fixture(params=["phys.nc","phys.zarr"])
+def archive(request,tmp_path):
+    pytest.importorskip("netCDF4" if request.param.endswith(".nc") else "zarr")
+    return str(tmp_path/request.param)
+
+def test_replay_matches_server(fake_mds,archive):
+    assert MDSmonkey.export_archive(1,"phys","srv",archive) == []
+    live = MDSmonkey.diagnosticXarray(MDSmonkey.get_tree(1,"phys","srv").diag)
+    conn = MDSmonkey.ArchiveConnection(archive)
+    replay = MDSmonkey.diagnosticXarray(MDSmonkey.get_tree(1,"phys",None,conn=conn).diag)
+    assert replay.identical(live)
+    assert MDSmonkey.get_data(1,r"\te","phys",conn=conn).identical(live.te)
+
+@pytest.mark.parametrize("selection",[r"\ne",r"\phys::top.diag:ne"])
+def test_subset_only_shows_archived_leaves(fake_mds,archive,selection):
+    MDSmonkey.export_archive(1,"phys","srv",archive,subset=[selection])
+    conn = MDSmonkey.ArchiveConnection(archive)
+    for trim in (True,False):
+        diag = MDSmonkey.get_tree(1,"phys",None,conn=conn,trim_dead_branches=trim).diag
+        assert list(diag.__getDescendants__()) == ["ne"]
+        #A tag brings the nodes below it along, just like a full path
+        assert set(diag.ne.__getDescendants__()) == {"data_err","data_err_h","data_err_l","description"}
+    assert list(MDSmonkey.diagnosticXarray(diag).data_vars) == ["ne"]
+
+def test_replay_several_shots(fake_mds,archive):
+    for shot in (1,2):
+        MDSmonkey.export_archive(shot,"phys","srv",archive)
+    live = MDSmonkey.get_many_shots([1,2],r"\te","phys",server="srv")
+    conn = MDSmonkey.ArchiveConnection(archive)
+    replay = MDSmonkey.get_many_shots([1,2],r"\te","phys",conn=conn)
+    assert replay.identical(live)
+    assert (replay.sel(shot=2) - replay.sel(shot=1) == 100).all()
+
+def test_export_resumes(fake_mds,archive):
+    fake_mds.connection.Connection.missing.add(r"\TE")
+    assert MDSmonkey.export_archive(1,"phys","srv",archive) == [r"\phys::top.diag:te"]
+    fake_mds.connection.Connection.missing.clear()
+    assert MDSmonkey.export_archive(1,"phys","srv",archive) == []
+    conn = MDSmonkey.ArchiveConnection(archive)
+    diag = MDSmonkey.get_tree(1,"phys",None,conn=conn).diag
+    assert list(MDSmonkey.diagnosticXarray(diag).data_vars) == ["ne","te"]
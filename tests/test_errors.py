@@ -0,0 +1,36 @@
+import pytest
+
+import MDSmonkey
+
+
+def test_with_errors(fake_mds):
+    ne = MDSmonkey.get_tree(1,"phys","srv").diag.ne
+    ds = ne.with_errors()
+    assert set(ds.data_vars) == {"NE","NE_err","NE_err_h","NE_err_l"}
+    assert ds.NE_err_h.dims == ds.NE.dims
+    assert ds.NE.attrs["description"] == "electron density"
+
+def test_include_errors_concat_keeps_each_description(fake_mds):
+    diag = MDSmonkey.get_tree(1,"phys","srv").diag
+    ds = MDSmonkey.diagnosticXarray(diag,behavior='concat',include_errors=True)
+    assert list(ds.description.values) == ["electron density","electron temperature"]
+    assert "description" not in ds.data.attrs
+
+def test_include_errors_merge(fake_mds):
+    diag = MDSmonkey.get_tree(1,"phys","srv").diag
+    ds = MDSmonkey.diagnosticXarray(diag,include_errors=True)
+    assert set(ds.data_vars) == {"ne","ne_err","ne_err_h","ne_err_l","te","te_err"}
+    assert ds.te.attrs["description"] == "electron temperature"
+
+def test_with_errors_leaves_out_companions_not_in_archive(fake_mds,tmp_path):
+    pytest.importorskip("netCDF4")
+    archive = str(tmp_path/"phys.nc")
+    fake_mds.connection.Connection.missing.add(r"\NE:DATA_ERR")
+    MDSmonkey.export_archive(1,"phys","srv",archive,subset=[r"\ne"])
+    conn = MDSmonkey.ArchiveConnection(archive)
+    ne = MDSmonkey.get_tree(1,"phys",None,conn=conn).diag.ne
+    assert set(ne.__getDescendants__()) == {"data_err_h","data_err_l","description"}
+    assert set(ne.with_errors().data_vars) == {"NE","NE_err_h","NE_err_l"}
+    #Even if asked for, the missing node is left out rather than failing
+    ne.data_err = MDSmonkey.Leaf(1,"phys",r"\phys::top.diag:ne:data_err",conn,r"\NE:DATA_ERR",usage=6,length=100)
+    assert set(ne.with_errors().data_vars) == {"NE","NE_err_h","NE_err_l"}
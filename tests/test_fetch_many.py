@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import MDSmonkey
+from conftest import Connection
+
+
+def test_timeout_without_deadline(fake_mds):
+    Connection.hang[r"\TE"] = 1.
+    start = time.monotonic()
+    ds = MDSmonkey.get_many([1,2],[r"\ne",r"\TE"],"phys",server="srv",timeout=0.3,workers=1)
+    assert time.monotonic() - start < 1.5
+    assert ds.status.sel(tag="ne").values.tolist() == ["ok","ok"]
+    assert ds.status.sel(tag="TE").values.tolist() == ["timeout","timeout"]
+    assert list(ds.data_vars) == ["ne","status"]
+
+def test_deadline_returns_partial_dataset(fake_mds):
+    Connection.hang[r"\TE"] = 1.
+    Connection.fail.add(3)
+    start = time.monotonic()
+    ds = MDSmonkey.get_many_shots([1,2,3],r"\TE","phys",server="srv",deadline=0.5,workers=3)
+    assert time.monotonic() - start < 1.
+    assert ds.status.values.ravel().tolist() == ["timeout","timeout","error"]
+
+def test_pending_with_shared_connection(fake_mds):
+    Connection.hang[r"\TE"] = 1.
+    ds = MDSmonkey.get_many_signals(1,[r"\ne",r"\TE",r"\ne:data_err"],"phys",
+                                    conn=Connection(),timeout=0.3)
+    assert ds.status.values.ravel().tolist() == ["ok","timeout","pending"]
+    assert list(ds.data_vars) == ["ne","status"]
+
+def test_concat_result_is_a_dataset(fake_mds,tmp_path):
+    pytest.importorskip("netCDF4")
+    ds = MDSmonkey.get_many_shots([1,2],r"\ne","phys",server="srv",timeout=5)
+    assert ds.status.values.ravel().tolist() == ["ok","ok"]
+    assert ds.ne.dims == ("shot","dim_0")
+    ds.to_netcdf(tmp_path/"ne.nc")
+
+def test_late_result_is_picked_up(fake_mds):
+    Connection.hang[r"\TE"] = 0.1 #4 requests per signal, so 0.4s in all
+    ds = MDSmonkey.get_many_shots([1],r"\TE","phys",server="srv",timeout=0.2)
+    assert ds.status.values.ravel().tolist() == ["timeout"]
+    time.sleep(0.5)
+    Connection.fail.add(1) #The server can't help any more
+    ds = MDSmonkey.get_many_shots([1],r"\TE","phys",server="srv",timeout=0.2)
+    assert ds.status.values.ravel().tolist() == ["ok"]
+
+def test_late_results_are_bounded(fake_mds,monkeypatch):
+    monkeypatch.setattr(MDSmonkey,"retry_cache_size",3)
+    for shot in range(10):
+        MDSmonkey._remember("srv","phys",(shot,r"\ne"),shot)
+    assert [key[2] for key in MDSmonkey._retried] == [7,8,9]
+    monkeypatch.setattr(MDSmonkey,"retry_cache_age",0.)
+    assert MDSmonkey._recall("srv","phys",(9,r"\ne")) is None
+    assert len(MDSmonkey._retried) == 0
+
+def test_list_keeps_a_placeholder_per_item(fake_mds):
+    Connection.fail.add(2)
+    shots = MDSmonkey.get_many_shots([1,2,3],r"\ne","phys",server="srv",behavior='list',timeout=5)
+    assert [ds is None for ds in shots] == [False,True,False]
+    assert shots[2].name == "ne"
+    signals = MDSmonkey.get_many([2],[r"\ne",r"\TE"],"phys",server="srv",
+                                 shot_behavior='list',tag_behavior='list',timeout=5)
+    assert signals == [None,None]
+
+def test_needs_a_worker(fake_mds):
+    with pytest.raises(ValueError):
+        MDSmonkey.fetch_many([(1,r"\ne")],"phys",server="srv",timeout=1,workers=0)
+
+def test_hung_item_is_not_asked_for_again(fake_mds):
+    Connection.hang[r"\TE"] = 1.
+    ds = MDSmonkey.get_many_shots([1],r"\TE","phys",server="srv",timeout=0.2)
+    assert ds.status.values.ravel().tolist() == ["timeout"]
+    start = time.monotonic()
+    ds = MDSmonkey.get_many_shots([1],r"\TE","phys",server="srv",timeout=0.2)
+    assert time.monotonic() - start < 0.1
+    assert ds.status.values.ravel().tolist() == ["timeout"]
+    assert MDSmonkey._background_threads() == 1
+
+def test_background_threads_are_capped(fake_mds,monkeypatch):
+    monkeypatch.setattr(MDSmonkey,"max_background_threads",1)
+    Connection.hang[r"\TE"] = 1.
+    results,status = MDSmonkey.fetch_many([(1,r"\TE"),(2,r"\TE"),(3,r"\ne")],"phys",
+                                          server="srv",timeout=0.2,workers=1)
+    assert status == {(1,r"\TE"):"timeout",(2,r"\TE"):"pending",(3,r"\ne"):"pending"}
+    assert MDSmonkey._background_threads() == 1
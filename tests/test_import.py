@@ -0,0 +1,11 @@
+import os
+import subprocess
+import sys
+
+
+def test_import_is_lightweight():
+    code = ("import sys, MDSmonkey; "
+            "print(sorted(m for m in ('MDSplus','xarray','numpy','django') if m in sys.modules))")
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable,"-c",code],cwd=repo,check=True,capture_output=True,text=True)
+    assert out.stdout.strip() == "[]"